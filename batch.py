@@ -0,0 +1,294 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from fb import FacebookArchiveReader
+from fb import FacebookExporter
+from fb import FacebookImageMirror
+from ghost import GhostImporter
+from ghost import FragmentCache
+from s3util import S3
+
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+        Run the tasks of many accounts on one shared thread pool. Accounts are served round robin,
+        and no account has more than its own concurrency limit of tasks in flight.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.queues = OrderedDict()
+        self.limits = {}
+        self.in_flight = {}
+        self.total_in_flight = 0
+        self.errors = []
+        self.cond = threading.Condition()
+
+    def add_account(self, account, concurrency):
+        with self.cond:
+            self.queues[account] = deque()
+            self.limits[account] = max(1, concurrency)
+            self.in_flight[account] = 0
+
+    def submit(self, account, fn, *args):
+        with self.cond:
+            self.queues[account].append((fn, args))
+            self.cond.notify_all()
+
+    def _next_task(self):
+        # rotate through the accounts, so one big account can't starve the others
+        for _ in range(len(self.queues)):
+            account, queue = next(iter(self.queues.items()))
+            self.queues.move_to_end(account)
+            if queue and self.in_flight[account] < self.limits[account]:
+                return account, queue.popleft()
+        return None, None
+
+    def _run_task(self, account, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.exception("Task failed for " + account)
+            with self.cond:
+                self.errors.append((account, e))
+        finally:
+            with self.cond:
+                self.in_flight[account] = self.in_flight[account] - 1
+                self.total_in_flight = self.total_in_flight - 1
+                self.cond.notify_all()
+
+    def run(self):
+        with self.cond:
+            while True:
+                if self.total_in_flight < self.max_workers:
+                    account, task = self._next_task()
+                    if task:
+                        fn, args = task
+                        self.in_flight[account] = self.in_flight[account] + 1
+                        self.total_in_flight = self.total_in_flight + 1
+                        self.executor.submit(self._run_task, account, fn, args)
+                        continue
+                if self.total_in_flight == 0 and not any(self.queues.values()):
+                    break
+                self.cond.wait()
+        self.executor.shutdown()
+        return self.errors
+
+
+class BatchJob:
+    """
+        Migrate one account: read the posts (from a Facebook download dir or the Graph API),
+        upload the images to S3, then post to Ghost in 5 year increments
+    """
+
+    def __init__(self, runner, spec):
+        self.runner = runner
+        self.archive_dir = spec.get('archive_dir')
+        self.fb_token = spec.get('fb_token')
+        if not self.archive_dir and not self.fb_token:
+            raise Exception("Batch job needs either archive_dir or fb_token: " + str(spec))
+        self.user_slug = spec['ghost_slug']
+        self.s3_bucket = spec['s3_bucket']
+        self.s3_image_folder = spec['s3_folder']
+        self.api_url = spec['ghost_api_url']
+        self.api_key = spec['ghost_api_key']
+        self.cache_dir = spec.get('cache_dir', '/tmp')
+        self.app_id = spec.get('app_id')
+        self.app_secret = spec.get('app_secret')
+        self.concurrency = spec.get('concurrency', 2)
+        self.name = spec.get('name', self.user_slug)
+
+        self.posts = []
+        self.existing_keys = None
+        self.pending_uploads = 0
+        self.pending_publishes = 0
+        self.lock = threading.Lock()
+
+        self.total_images = 0
+        self.total_ghost_posts = 0
+        self.start_time = None
+        self.end_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.runner.scheduler.submit(self.name, self._read)
+
+    def _finish(self):
+        with self.lock:
+            self.end_time = time.time()
+
+    def _read(self):
+        if self.archive_dir:
+            posts = FacebookArchiveReader.read(self.archive_dir)
+        else:
+            token = self.fb_token
+            if self.app_id and self.app_secret:
+                token = FacebookExporter.get_long_lived_token(self.app_id, self.app_secret, token)
+            # the Graph cache keys leave out the access token, so every account needs its own cache dir
+            graph_cache_dir = os.path.join(self.cache_dir, 'graph', self.name)
+            os.makedirs(graph_cache_dir, exist_ok=True)
+            fb_exporter = FacebookExporter([token], tmp_dir=graph_cache_dir, http=self.runner.http)
+            posts = fb_exporter.get_posts(0, ignore_error=True)
+
+        if not self.archive_dir:
+            # mirror all the posts at once, so images shared by several posts are downloaded once
+            FacebookImageMirror.mirror(self.cache_dir, posts, max_workers=self.concurrency, http=self.runner.http)
+
+        self.posts = posts
+        self.existing_keys = self.runner.get_existing_keys(self.s3_bucket, self.s3_image_folder)
+
+        posts_with_images = [post for post in posts if post[3]]
+        self.pending_uploads = len(posts_with_images)
+        if not posts_with_images:
+            self._publish_all()
+        for post in posts_with_images:
+            self.runner.scheduler.submit(self.name, self._upload, post)
+
+    def _upload(self, post):
+        try:
+            S3.upload_local_images_to_s3(self.s3_bucket, self.s3_image_folder, [post],
+                                         existing_keys=self.existing_keys)
+            with self.lock:
+                self.total_images = self.total_images + len(post[3])
+        finally:
+            # publish once the last upload is done, even if some of them failed
+            with self.lock:
+                self.pending_uploads = self.pending_uploads - 1
+                done = self.pending_uploads == 0
+            if done:
+                self._publish_all()
+
+    def _publish_all(self):
+        posts_by_5years = GhostImporter.group_posts_by_5years(self.posts)
+        if not posts_by_5years:
+            self._finish()
+            return
+        self.pending_publishes = len(posts_by_5years)
+        gi = GhostImporter(self.api_url, self.api_key, self.user_slug, http=self.runner.http,
+                           fragment_cache=self.runner.fragment_cache)
+        for year, posts in posts_by_5years.items():
+            self.runner.scheduler.submit(self.name, self._publish, gi, year, posts)
+
+    def _publish(self, gi, year, posts):
+        try:
+            slug = self.user_slug + "_" + str(year + 1) + "_" + str(year + 5)
+            title = "The Years %d-%d, According to Facebook" % (year + 1, year + 5)
+            gi.create_post(slug, title, posts)
+            with self.lock:
+                self.total_ghost_posts = self.total_ghost_posts + 1
+        finally:
+            with self.lock:
+                self.pending_publishes = self.pending_publishes - 1
+                done = self.pending_publishes == 0
+            if done:
+                self._finish()
+
+    def report(self):
+        elapsed = (self.end_time or time.time()) - self.start_time if self.start_time else 0
+        posts_per_sec = len(self.posts) / elapsed if elapsed > 0 else 0
+        images_per_sec = self.total_images / elapsed if elapsed > 0 else 0
+        return "%s: %d posts, %d images, %d ghost posts in %.1fs (%.2f posts/s, %.2f images/s)" % (
+            self.name, len(self.posts), self.total_images, self.total_ghost_posts, elapsed,
+            posts_per_sec, images_per_sec)
+
+
+class BatchRunner:
+    """
+        Run many migrations in one process, sharing the S3 client, HTTP connection pools,
+        the geocode cache, the compiled post template and the rendered post fragments across all of them.
+
+        The manifest is a JSON file. Top level settings are the defaults for every job:
+
+        {
+          "max_workers": 8,
+          "concurrency": 2,
+          "cache_dir": "/tmp/fb_cache",
+          "app_id": "...", "app_secret": "...",
+          "ghost_api_url": "https://blog.example.com/ghost/api/v3", "ghost_api_key": "...",
+          "s3_bucket": "my-bucket",
+          "jobs": [
+            { "archive_dir": "/data/facebook-alice", "ghost_slug": "alice", "s3_folder": "fb_images/alice" },
+            { "fb_token": "...", "ghost_slug": "bob", "s3_folder": "fb_images/bob", "concurrency": 4 }
+          ]
+        }
+    """
+
+    def __init__(self, manifest):
+        self.max_workers = manifest.get('max_workers', 8)
+        self.scheduler = FairScheduler(self.max_workers)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+
+        # rendered posts, shared by every job and kept across runs
+        self.fragment_cache = FragmentCache(manifest.get('cache_dir', '/tmp'))
+
+        # S3 listings, and a lock per prefix so only jobs sharing a prefix wait on each other's listing
+        self.s3_keys = {}
+        self.s3_keys_locks = {}
+        self.s3_keys_lock = threading.Lock()
+
+        defaults = {k: v for k, v in manifest.items() if k != 'jobs'}
+        self.jobs = []
+        for job_spec in manifest['jobs']:
+            spec = dict(defaults)
+            spec.update(job_spec)
+            job = BatchJob(self, spec)
+            if job.name in self.scheduler.queues:
+                raise Exception("Duplicate batch job " + job.name)
+            self.scheduler.add_account(job.name, job.concurrency)
+            self.jobs.append(job)
+
+    @staticmethod
+    def from_manifest(manifest_file):
+        manifest = json.loads(open(manifest_file, 'r').read())
+        return BatchRunner(manifest)
+
+    def get_existing_keys(self, s3_bucket, s3_image_folder):
+        # list each S3 prefix only once, however many jobs share it
+        key = (s3_bucket, s3_image_folder)
+        with self.s3_keys_lock:
+            prefix_lock = self.s3_keys_locks.setdefault(key, threading.Lock())
+        with prefix_lock:
+            if key not in self.s3_keys:
+                self.s3_keys[key] = set(S3.get_keys(s3_bucket, s3_image_folder))
+            return self.s3_keys[key]
+
+    def run(self):
+        start_time = time.time()
+        for job in self.jobs:
+            job.start()
+        errors = self.scheduler.run()
+        self.fragment_cache.save()
+        elapsed = time.time() - start_time
+
+        for job in self.jobs:
+            logging.info(job.report())
+        total_posts = sum(len(job.posts) for job in self.jobs)
+        total_images = sum(job.total_images for job in self.jobs)
+        logging.info("Migrated %d accounts, %d posts, %d images in %.1fs with %d errors" % (
+            len(self.jobs), total_posts, total_images, elapsed, len(errors)))
+        return errors
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("usage: <batch manifest json>")
+        exit(-1)
+
+    BatchRunner.from_manifest(sys.argv[1]).run()
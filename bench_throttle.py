@@ -0,0 +1,102 @@
+"""
+    Export posts from a stub Graph API on a simulated clock, with and without the usage headers,
+    to compare the adaptive GraphThrottle against the fixed hourly_limit pace.
+"""
+import json
+import logging
+import sys
+import tempfile
+import time
+import fb
+from fb import FacebookExporter
+
+
+class SimulatedClock:
+    """
+        Stands in for the time module in fb, so sleeping just moves the clock forward
+    """
+
+    def __init__(self):
+        self.now = time.time()
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now = self.now + secs
+        self.slept = self.slept + secs
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class GraphStubResponse:
+
+    def __init__(self, body, headers):
+        self.status_code = 200
+        self.text = json.dumps(body)
+        self.headers = headers
+
+
+class GraphStub:
+    """
+        Answers /me, /me/posts and /<post>/attachments. Reports usage the way Facebook does: the percentage of
+        the hourly quota used by the calls of the last hour.
+    """
+
+    def __init__(self, clock, posts, hourly_quota=180, emit_usage=True):
+        self.clock = clock
+        self.posts = posts
+        self.hourly_quota = hourly_quota
+        self.emit_usage = emit_usage
+        self.call_times = []
+
+    def get(self, url, **kwargs):
+        now = self.clock.time()
+        self.call_times.append(now)
+        headers = {}
+        if self.emit_usage:
+            recent = len([t for t in self.call_times if t > now - 3600])
+            usage = min(100, int(100 * recent / self.hourly_quota))
+            if recent > self.hourly_quota:
+                raise Exception("Stub Graph API rate limit exceeded")
+            headers['X-App-Usage'] = json.dumps({'call_count': usage, 'total_time': usage // 2, 'total_cputime': 1})
+
+        if '/attachments' in url:
+            body = {'data': []}
+        elif '/me/posts' in url:
+            body = {'data': [{'id': str(i), 'created_time': '2010-01-01T00:00:00+0000'} for i in range(self.posts)]}
+        else:
+            body = {'name': 'stub'}
+        return GraphStubResponse(body, headers)
+
+
+def run(posts, hourly_quota, emit_usage):
+    clock = SimulatedClock()
+    real_time = fb.time
+    fb.time = clock
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            stub = GraphStub(clock, posts, hourly_quota=hourly_quota, emit_usage=emit_usage)
+            exporter = FacebookExporter(['token'], tmp_dir=cache_dir, http=stub)
+            start = clock.time()
+            exported = exporter.get_posts(max_pages=1)
+            elapsed = clock.time() - start
+    finally:
+        fb.time = real_time
+    return len(exported), len(stub.call_times), elapsed
+
+
+if __name__ == "__main__":
+
+    # usage: python bench_throttle.py [<posts> [<real hourly quota>]]
+    # FacebookExporter paces itself for hourly_limit=180 calls, the real quota is often higher
+    logging.getLogger().setLevel(logging.ERROR)
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    hourly_quota = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+
+    for emit_usage, label in ((False, "fixed"), (True, "adaptive")):
+        exported, calls, elapsed = run(posts, hourly_quota, emit_usage)
+        rate = "%.2f posts/min" % (exported * 60 / elapsed) if elapsed else "no waiting"
+        print("%-8s %d posts, %d calls in %.0f simulated secs (%s)" % (label, exported, calls, elapsed, rate))
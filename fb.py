@@ -7,8 +7,15 @@ from s3util import S3
 import glob
 import os
 import html
+import hashlib
+import threading
+import urllib.parse
 import requests
 import reverse_geocode
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from collections import deque
+from functools import lru_cache
 from functools import partial
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -43,7 +50,9 @@ class FacebookArchiveReader:
         return html.unescape(str).replace('"', '')
 
     @staticmethod
+    @lru_cache(maxsize=65536)
     def _reverse_gcode(latitude, longitude):
+        # cached per process, so photos taken at the same spot (and batch jobs sharing this process) only look up once
         if latitude:
             cities = reverse_geocode.search([(latitude, longitude)])
             if cities:
@@ -134,20 +143,119 @@ class FacebookArchiveReader:
 
 
 
+class GraphThrottle:
+    """
+        Pace the Graph API calls of one token from the usage Facebook reports back in the
+        X-App-Usage and X-Business-Use-Case-Usage headers (percent of the quota used so far).
+        No delay while usage is low, then up to the fixed hourly limit pace as it grows. Close to the limit,
+        wait for our own calls to age out of Facebook's one hour window instead.
+        Until a response carries those headers, fall back to the fixed hourly limit.
+    """
+
+    def __init__(self, fallback_secs, max_secs=3600, low_water=50, high_water=92, warn_at=80):
+        """
+        :param fallback_secs: seconds between calls when Facebook doesn't report usage (the hourly limit pace)
+        :param max_secs: longest wait between calls, a full quota window by default
+        :param low_water: usage percentage below which we don't wait at all
+        :param high_water: usage percentage up to which we never wait longer than the hourly limit pace
+        :param warn_at: usage percentage at which to start warning about the rate limit
+        """
+        self.fallback_secs = fallback_secs
+        self.max_secs = max_secs
+        self.low_water = low_water
+        self.high_water = high_water
+        self.warn_at = warn_at
+        self.usage = None
+        self.regain_secs = 0
+        self.next_call_time = 0
+        # our own calls in the last hour, the window Facebook counts usage over
+        self.call_times = deque()
+
+    @staticmethod
+    def parse_usage(headers):
+        """
+        :return: (highest usage percentage, seconds until access is regained). Usage is None if not reported.
+        """
+        usage = None
+        regain_secs = 0
+        try:
+            app_usage = headers.get('X-App-Usage')
+            if app_usage:
+                usage = max(json.loads(app_usage).values())
+            buc_usage = headers.get('X-Business-Use-Case-Usage')
+            if buc_usage:
+                for entries in json.loads(buc_usage).values():
+                    for entry in entries:
+                        pct = max(entry.get('call_count', 0), entry.get('total_cputime', 0), entry.get('total_time', 0))
+                        usage = pct if usage is None else max(usage, pct)
+                        regain_secs = max(regain_secs, entry.get('estimated_time_to_regain_access', 0) * 60)
+        except (ValueError, TypeError, AttributeError):
+            logging.warning("Can't parse Graph API usage headers: " + str(headers.get('X-App-Usage')) + ", " + str(headers.get('X-Business-Use-Case-Usage')))
+        return usage, regain_secs
+
+    def _quota_wait(self, now):
+        """
+        Near the limit, estimate the quota from our own calls in the last hour and the usage Facebook reports,
+        and wait until enough of those calls age out of the window for one more
+        """
+        # usage is rounded down, so count it one higher to stay on the safe side
+        quota = int(len(self.call_times) * 100 / (self.usage + 1))
+        excess = len(self.call_times) + 1 - quota
+        if excess <= 0:
+            return 0
+        return self.call_times[excess - 1] + 3600 - now
+
+    def _interval(self, now):
+        if self.regain_secs:
+            return self.regain_secs
+        if self.usage is None:
+            return self.fallback_secs
+        if self.usage <= self.low_water:
+            return 0
+        if self.usage <= self.high_water:
+            # ramp up from no delay at the low water mark, but never slower than the hourly limit pace
+            return min(self.fallback_secs, self.fallback_secs * (self.usage - self.low_water) / (100 - self.usage))
+        # close to the limit, go by the room left in the window: as calls age out of it we can make more,
+        # once it's full we wait for them, up to max_secs
+        return min(self.max_secs, self._quota_wait(now))
+
+    def update(self, headers):
+        now = time.time()
+        self.call_times.append(now)
+        while self.call_times[0] <= now - 3600:
+            self.call_times.popleft()
+
+        # without usage headers, don't trust an old reading, fall back to the fixed pace
+        usage, regain_secs = GraphThrottle.parse_usage(headers)
+        self.usage = usage
+        self.regain_secs = regain_secs
+        if usage is not None and usage >= self.warn_at:
+            logging.warning("Graph API usage at %d%%, slowing down to avoid the rate limit" % usage)
+        self.next_call_time = now + self._interval(now)
+
+    def wait(self):
+        delay = self.next_call_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
 class FacebookExporter:
     """
         Download the posts and their attachments.
         Check out https://developers.facebook.com/tools/explorer/
     """
 
-    def __init__(self, fb_tokens, tmp_dir='/tmp', hourly_limit=180):
+    def __init__(self, fb_tokens, tmp_dir='/tmp', hourly_limit=180, http=None):
         """
         :param fb_tokens: the FB user access tokens. Each token should have user_photos, user_posts and public_profile permissions.
+        :param http: a requests.Session to share connection pools with other exporters, defaults to plain requests
         """
+        self.http = http or requests
         self.fb_tokens = fb_tokens
         self.tmp_dir = tmp_dir
         self.curr_token_idx = 0
         self.secs_between_fb_calls = 3600 / len(fb_tokens) / hourly_limit
+        self.throttles = [GraphThrottle(self.secs_between_fb_calls) for _ in fb_tokens]
 
     def _fb_token(self):
         return self.fb_tokens[self.curr_token_idx]
@@ -182,8 +290,11 @@ class FacebookExporter:
             return result
         else:
             while True:
+                throttle = self.throttles[self.curr_token_idx]
+                throttle.wait()
                 logging.info("Fetching " + request_url + "...")
-                response = requests.get(request_url)
+                response = self.http.get(request_url)
+                throttle.update(response.headers)
                 if response.status_code > 400:
                     # Rate limit exceeded? switch to next app/token
                     self.curr_token_idx = self.curr_token_idx + 1
@@ -193,7 +304,6 @@ class FacebookExporter:
                     else:
                         logging.warning("Got 40x, trying next token: " + str(response.status_code))
                 else:
-                    time.sleep(self.secs_between_fb_calls)
                     break
 
             if response.status_code < 300:
@@ -292,6 +402,130 @@ class FacebookExporter:
         return posts
 
 
+class FacebookImageMirror:
+    """
+        Keep a local copy of the Graph API attachment images in the cache dir, so they go through the same
+        local file upload path as a Facebook download, and re-runs never fetch them from the CDN again
+    """
+
+    @staticmethod
+    def _image_key(image_url):
+        # the CDN signs its urls with query parameters that change between runs, the path doesn't
+        path = urllib.parse.urlsplit(image_url).path
+        ext = os.path.splitext(path)[1] or '.jpg'
+        return hashlib.md5(path.encode()).hexdigest() + ext
+
+    # one lock per image file, so mirrors sharing a cache dir never download the same image at the same time
+    _file_locks = {}
+    _file_locks_lock = threading.Lock()
+
+    @staticmethod
+    def _download(image_url, image_file, http=requests):
+        with FacebookImageMirror._file_locks_lock:
+            file_lock = FacebookImageMirror._file_locks.setdefault(image_file, threading.Lock())
+        with file_lock:
+            return FacebookImageMirror._download_file(image_url, image_file, http)
+
+    @staticmethod
+    def _download_file(image_url, image_file, http=requests):
+        meta_file = image_file + '.json'
+        part_file = image_file + '.part'
+
+        meta = json.loads(open(meta_file, 'r').read()) if os.path.isfile(meta_file) else {}
+        if os.path.isfile(image_file):
+            if meta.get('size') is None or os.path.getsize(image_file) == meta['size']:
+                return False
+            logging.warning("Mirrored image has the wrong size, downloading again: " + image_file)
+            os.remove(image_file)
+
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if offset and offset == meta.get('size'):
+            # the last run got the whole image, but stopped before moving it into place
+            os.replace(part_file, image_file)
+            return True
+
+        # resume a partial download, as long as the image hasn't changed since (same ETag)
+        headers = {}
+        if offset and meta.get('etag'):
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': meta['etag']}
+
+        response = http.get(image_url, headers=headers, stream=True)
+        if response.status_code == 416 and headers:
+            # nothing past what we already have, but we can't tell it's complete, so start over
+            response.close()
+            os.remove(part_file)
+            headers = {}
+            response = http.get(image_url, headers=headers, stream=True)
+
+        try:
+            if response.status_code == 206 and headers:
+                mode = 'ab'
+            elif response.status_code == 200:
+                mode = 'wb'
+                offset = 0
+            else:
+                raise Exception("Failed to download image %d: %s" % (response.status_code, image_url))
+
+            length = response.headers.get('Content-Length')
+            size = offset + int(length) if length else None
+            open(meta_file, 'w').write(json.dumps({'url': image_url, 'etag': response.headers.get('ETag'), 'size': size}))
+
+            with open(part_file, mode) as f:
+                for chunk in response.raw.stream(65536, decode_content=False):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        if size is not None and os.path.getsize(part_file) != size:
+            # keep the partial file, the next run picks up from there
+            raise Exception("Incomplete download %d of %d bytes: %s" % (os.path.getsize(part_file), size, image_url))
+        os.replace(part_file, image_file)
+        return True
+
+    @staticmethod
+    def mirror(cache_dir, posts, max_workers=8, ignore_error=True, http=requests):
+        """
+        Download the remote images of the posts into <cache dir>/fb_images. Mirrored images get a local 'file'
+        and a 'mirror_key' (and lose their remote 'src', which changes from run to run), ready for
+        S3.upload_local_images_to_s3
+        :return: the posts
+        """
+        image_dir = cache_dir + "/fb_images"
+        os.makedirs(image_dir, exist_ok=True)
+
+        # the same image can be attached to many posts, download it once
+        image_files = {}
+        for (post_id, created_time, message, images, *_) in posts:
+            for image in images:
+                if image.get('src') and not image.get('file'):
+                    image_file = image_dir + "/" + FacebookImageMirror._image_key(image['src'])
+                    image_files.setdefault(image_file, []).append(image)
+
+        downloaded = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(FacebookImageMirror._download, images[0]['src'], image_file, http): image_file
+                       for image_file, images in image_files.items()}
+            for future in as_completed(futures):
+                image_file = futures[future]
+                images = image_files[image_file]
+                try:
+                    if future.result():
+                        downloaded = downloaded + 1
+                except Exception as e:
+                    if ignore_error:
+                        logging.error("Failed to mirror image " + images[0]['src'] + ": " + str(e))
+                        continue
+                    else:
+                        raise e
+                for image in images:
+                    del image['src']
+                    image['file'] = image_file
+                    image['mirror_key'] = os.path.basename(image_file)
+
+        logging.info("Mirrored %d images, downloaded %d" % (len(image_files), downloaded))
+        return posts
+
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 5 :
@@ -309,10 +543,11 @@ if __name__ == "__main__":
         s3_image_folder = sys.argv[6]
         logging.info("Will upload all images to " + s3_bucket + "/" + s3_image_folder)
 
-    fb_exporter = FacebookExporter(FacebookExporter.get_long_lived_token(app_id, app_secret, user_access_token), tmp_dir=cache_dir)
+    fb_exporter = FacebookExporter([FacebookExporter.get_long_lived_token(app_id, app_secret, user_access_token)], tmp_dir=cache_dir)
     posts = fb_exporter.get_posts(0, ignore_error=True)
 
     if upload_images:
-        S3.upload_images_to_s3(s3_bucket, s3_image_folder, posts)
+        posts = FacebookImageMirror.mirror(cache_dir, posts)
+        S3.upload_local_images_to_s3(s3_bucket, s3_image_folder, posts)
 
 
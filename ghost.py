@@ -5,6 +5,8 @@ import os
 import json
 import hashlib
 import re
+import threading
+from collections import OrderedDict
 from datetime import datetime as date
 import sys
 from fb import FacebookExporter
@@ -15,11 +17,81 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger(__name__)
 
 
+class FragmentCache:
+    """
+        The rendered mobiledoc fragments (gallery card and sections) of each post, kept in a file in the cache dir
+        across runs. Old Facebook posts don't change, so publishing a bucket again mostly stitches cached fragments
+        together. Entries are keyed by account and post id (archive post ids are just timestamps, so different
+        accounts can share them) and checked against a hash of the post, the render options and the
+        template, so a changed post or post.hb just re-renders. Beyond max_entries, the least recently used posts
+        are evicted. Call save() at the end of the run to keep the fragments for the next one.
+    """
+
+    def __init__(self, cache_dir='/tmp', max_entries=100000):
+        self.cache_file = cache_dir + "/ghost_fragments.json"
+        self.max_entries = max_entries
+        self.fragments = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.fragments is None:
+            self.fragments = OrderedDict()
+            if os.path.isfile(self.cache_file):
+                try:
+                    self.fragments.update(json.loads(open(self.cache_file, 'r').read()))
+                except ValueError:
+                    logging.warning("Ignoring bad fragment cache " + self.cache_file)
+
+    @staticmethod
+    def _key(account, post_id):
+        return account + "/" + post_id if account else post_id
+
+    def get(self, account, post_id, content_hash):
+        key = FragmentCache._key(account, post_id)
+        with self.lock:
+            self._load()
+            entry = self.fragments.get(key)
+            if entry and entry['hash'] == content_hash:
+                # mark as recently used. That alone isn't worth rewriting the file, the order is saved with the next put
+                self.fragments.move_to_end(key)
+                return entry['fragment']
+        return None
+
+    def put(self, account, post_id, content_hash, fragment):
+        key = FragmentCache._key(account, post_id)
+        with self.lock:
+            self._load()
+            self.fragments[key] = {'hash': content_hash, 'fragment': fragment}
+            self.fragments.move_to_end(key)
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                tmp_file = self.cache_file + ".tmp"
+                open(tmp_file, 'w').write(json.dumps(self.fragments))
+                os.replace(tmp_file, self.cache_file)
+                self.dirty = False
+                logging.info("Saved %d post fragments to %s" % (len(self.fragments), self.cache_file))
+
+
 class GhostImporter:
-    def __init__(self, api_url, admin_api_key, user_slug):
+
+    # compiled Handlebars templates, keyed by template file. pybars' Compiler isn't thread safe, so compile under a lock
+    _templates = {}
+    _templates_lock = threading.Lock()
+
+    def __init__(self, api_url, admin_api_key, user_slug, http=None, fragment_cache=None):
         """
         :param admin_api_key: the Ghost Admin API key
+        :param http: a requests.Session to share connection pools with other importers, defaults to plain requests
+        :param fragment_cache: a FragmentCache to reuse the rendered posts from earlier runs
         """
+        self.http = http or requests
+        self.fragment_cache = fragment_cache
         self.admin_api_key = admin_api_key
         self.api_url = api_url
         self.user_slug = user_slug
@@ -47,7 +119,7 @@ class GhostImporter:
     def get_post(self, post_id):
         url = self.api_url + '/admin/posts/' + post_id
         headers = {'Authorization': 'Ghost {}'.format(self._get_jwt_token().decode())}
-        response = requests.get(url, headers=headers)
+        response = self.http.get(url, headers=headers)
         result = json.loads(response.text) if response.status_code == 200 else None
         return result
 
@@ -58,7 +130,7 @@ class GhostImporter:
         while max_pages == 0 or page < max_pages:
             url = self.api_url + '/admin/posts?order=title%20asc&page=' + str(page)
             headers = {'Authorization': 'Ghost {}'.format(self._get_jwt_token().decode())}
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             if response.status_code == 200:
                 results = json.loads(response.text)
                 posts = results['posts']
@@ -106,48 +178,123 @@ class GhostImporter:
             image['height'] = height
 
     @staticmethod
-    def render_post_json(posts, images_per_row=2, max_width=512, template_file='post.hb'):
-
-        fb_posts = []
-        post_idx = 0
-        for post_id, created_time, message, images, locations, places, tags in posts:
-            post_idx = post_idx + 1
-            post_images = []
-            for i in range(0, len(images)):
-                image = images[i]
-                if image.get('src'):
-                    image_url = image['src']
-                    image_url_hash = hashlib.md5(image_url.encode()).hexdigest()
-                    GhostImporter._resize_image(image)
-                    post_image = {
-                        'filename' : image_url_hash,
-                        'width' : image['width'],
-                        'height': image['height'],
-                        'src' : image_url,
-                        'row' : int(i / images_per_row)
-                    }
-                    post_images.append(post_image)
-
-            message_lines =  [m for m in message.replace('"','').splitlines() if m.strip()] if message else []
-
-            fb_post = {
-                'date' : re.sub(" .*", "", created_time),
-                'message' : message_lines,
-                'has_image' : len(post_images) > 0,
-                'has_locations': locations and len(locations) > 0,
-                'gallery_idx' : post_idx,
-                'images': post_images,
-                'locations' : ",".join(locations) if locations else None,
-                'places' : places,
-                'tags' : [ ("with " + ", ".join(tags)) ] if tags else None
-            }
-            fb_posts.append(fb_post)
-
-        compiler = Compiler()
-        template_source = open(template_file, 'r').read()
-        template = compiler.compile(template_source)
-        output = template( { 'fb_posts' : fb_posts })
-        return output
+    def _get_template(template_file):
+        """
+        :return: (compiled template, hash of the template source)
+        """
+        with GhostImporter._templates_lock:
+            template = GhostImporter._templates.get(template_file)
+            if not template:
+                template_source = open(template_file, 'r').read()
+                template = (Compiler().compile(template_source), hashlib.md5(template_source.encode()).hexdigest())
+                GhostImporter._templates[template_file] = template
+            return template
+
+    @staticmethod
+    def _content_hash(post, images_per_row, max_width, template_hash):
+        # only hash what gets rendered of the images, not where their local copy happens to be
+        (post_id, created_time, message, images, locations, places, tags) = post
+        images = [[image.get('src'), image.get('width'), image.get('height')] for image in images]
+        post = (post_id, created_time, message, images, locations, places, tags)
+        # locations can be a set, sort it so the hash is the same from run to run
+        content = json.dumps([post, images_per_row, max_width, template_hash], sort_keys=True,
+                             default=lambda o: sorted(o) if isinstance(o, set) else str(o))
+        return hashlib.md5(content.encode()).hexdigest()
+
+    @staticmethod
+    def _render_fragment(template, post, images_per_row, max_width):
+        """
+        Render a single post with the template, and cut it up into its gallery card and its sections.
+        Rendered on its own, the post's gallery is card 1 (after the hr card).
+        """
+        (post_id, created_time, message, images, locations, places, tags) = post
+        post_images = []
+        for i in range(0, len(images)):
+            image = dict(images[i])
+            if image.get('src'):
+                image_url = image['src']
+                image_url_hash = hashlib.md5(image_url.encode()).hexdigest()
+                GhostImporter._resize_image(image, max_width)
+                post_image = {
+                    'filename' : image_url_hash,
+                    'width' : image['width'],
+                    'height': image['height'],
+                    'src' : image_url,
+                    'row' : int(i / images_per_row)
+                }
+                post_images.append(post_image)
+
+        message_lines =  [m for m in message.replace('"','').splitlines() if m.strip()] if message else []
+
+        fb_post = {
+            'date' : re.sub(" .*", "", created_time),
+            'message' : message_lines,
+            'has_image' : len(post_images) > 0,
+            'has_locations': locations and len(locations) > 0,
+            'gallery_idx' : 1,
+            'images': post_images,
+            'locations' : ",".join(locations) if locations else None,
+            'places' : places,
+            'tags' : [ ("with " + ", ".join(tags)) ] if tags else None
+        }
+
+        output = template( { 'fb_posts' : [fb_post] })
+        try:
+            mdoc = json.loads(str(output))
+        except ValueError as e:
+            raise Exception("Post %s doesn't render to valid mobiledoc: %s\n%s" % (post_id, str(e), output))
+        return {
+            'version': mdoc['version'],
+            'markups': mdoc['markups'],
+            'atoms': mdoc['atoms'],
+            'card': mdoc['cards'][1],
+            'sections': mdoc['sections']
+        }
+
+    @staticmethod
+    def render_post_json(posts, images_per_row=2, max_width=512, template_file='post.hb', fragment_cache=None,
+                         account=None):
+        """
+        :param fragment_cache: a FragmentCache to reuse the rendered posts from earlier runs
+        :param account: whose posts these are, to tell apart the cached posts of different accounts
+        """
+
+        template, template_hash = GhostImporter._get_template(template_file)
+
+        mdoc = None
+        hits = 0
+        for post in posts:
+            post_id = post[0]
+            fragment = None
+            if fragment_cache:
+                content_hash = GhostImporter._content_hash(post, images_per_row, max_width, template_hash)
+                fragment = fragment_cache.get(account, post_id, content_hash)
+            if fragment:
+                hits = hits + 1
+            else:
+                fragment = GhostImporter._render_fragment(template, post, images_per_row, max_width)
+                if fragment_cache:
+                    fragment_cache.put(account, post_id, content_hash, fragment)
+
+            if not mdoc:
+                mdoc = {
+                    'version': fragment['version'],
+                    'markups': fragment['markups'],
+                    'atoms': fragment['atoms'],
+                    'cards': [["hr", {}]],
+                    'sections': []
+                }
+
+            # every post has a gallery card, renumber the post's reference to it
+            gallery_idx = len(mdoc['cards'])
+            mdoc['cards'].append(fragment['card'])
+            for section in fragment['sections']:
+                mdoc['sections'].append([10, gallery_idx] if section == [10, 1] else section)
+
+        if fragment_cache:
+            logging.info("Rendered %d posts, %d from the fragment cache" % (len(posts), hits))
+
+        return json.dumps(mdoc)
 
     def create_post(self, slug, title, posts, replace=True):
         headers = {'Authorization': 'Ghost {}'.format(self._get_jwt_token().decode()),
@@ -156,24 +303,25 @@ class GhostImporter:
         # check if the post already exists
 
         request_url = self.api_url + "/admin/posts/slug/" + slug
-        response = requests.get(request_url, headers=headers)
+        response = self.http.get(request_url, headers=headers)
         existing_post = None
         if response.status_code == 200:
             existing_post = json.loads(response.text)['posts'][0]
 
-        mdoc_json = GhostImporter.render_post_json(posts)
+        mdoc_json = GhostImporter.render_post_json(posts, fragment_cache=self.fragment_cache,
+                                                   account=self.user_slug)
         post = { 'posts': [{ 'slug': slug, 'title' : title, 'mobiledoc' : mdoc_json }] }
 
         if existing_post:
             # delete first
             request_url = self.api_url + '/admin/posts/' + existing_post['id']
-            response = requests.delete(request_url, headers=headers)
+            response = self.http.delete(request_url, headers=headers)
             if response.status_code != 204:
                 raise Exception("Failed to clean up post %d : %s" % (response.status_code, response.text))
 
         request_url = self.api_url + '/admin/posts'
         payload = json.dumps(post)
-        response = requests.post(request_url, headers=headers, data=payload)
+        response = self.http.post(request_url, headers=headers, data=payload)
 
         if response.status_code == 201:
             logging.info("Created post " + response.text)
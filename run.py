@@ -2,8 +2,11 @@ import sys
 import logging
 from fb import FacebookArchiveReader
 from fb import FacebookExporter
+from fb import FacebookImageMirror
 from ghost import GhostImporter
+from ghost import FragmentCache
 from s3util import S3
+from batch import BatchRunner
 
 if __name__ == "__main__":
 
@@ -16,7 +19,13 @@ if __name__ == "__main__":
                             [ <s3 bucket> <s3 image folder> ]
                             OR
                          download <facebook download dir>  <ghost api url (including version)> <ghost api key> <ghost user slug> <s3 bucket> <s3 image folder> 
+                            OR
+                         batch <manifest json>
               """)
+    elif sys.argv[1] == 'batch':
+        # many accounts in one process, see BatchRunner for the manifest format
+        errors = BatchRunner.from_manifest(sys.argv[2]).run()
+        sys.exit(1 if errors else 0)
     elif sys.argv[1] == 'api' :
 
         cache_dir = sys.argv[2]
@@ -35,13 +44,16 @@ if __name__ == "__main__":
             s3_image_folder = sys.argv[10]
             logging.info("Will upload all images to " + s3_bucket + "/" + s3_image_folder)
 
-            # export from Facebook
+        # export from Facebook
 
-            fb_exporter = FacebookExporter(FacebookExporter.get_long_lived_token(app_id, app_secret, user_access_token), tmp_dir=cache_dir)
-            posts = fb_exporter.get_posts(0, ignore_error=True)
+        fb_exporter = FacebookExporter([FacebookExporter.get_long_lived_token(app_id, app_secret, user_access_token)], tmp_dir=cache_dir)
+        posts = fb_exporter.get_posts(0, ignore_error=True)
+        fragment_cache = FragmentCache(cache_dir)
 
-            if upload_images:
-                S3.upload_images_to_s3(s3_bucket, s3_image_folder, posts, ignore_error=True)
+        if upload_images:
+            # mirror the images locally first, so re-runs don't download them again
+            posts = FacebookImageMirror.mirror(cache_dir, posts)
+            posts = S3.upload_local_images_to_s3(s3_bucket, s3_image_folder, posts)
 
     elif sys.argv[1] == 'download':
         fb_download_dir = sys.argv[2]
@@ -53,6 +65,7 @@ if __name__ == "__main__":
         upload_images = True
 
         posts = FacebookArchiveReader.read(fb_download_dir)
+        fragment_cache = FragmentCache()
 #        posts = FacebookArchiveReader.read_file(fb_download_dir, "/Users/wen/Downloads/facebook-chihpo/posts/test.json")
         posts = S3.upload_local_images_to_s3(s3_bucket, s3_image_folder, posts)
 
@@ -60,7 +73,7 @@ if __name__ == "__main__":
 
     posts_by_5years = GhostImporter.group_posts_by_5years(posts)
 
-    gi = GhostImporter(api_url, api_key, user_slug)
+    gi = GhostImporter(api_url, api_key, user_slug, fragment_cache=fragment_cache)
     posts = gi.get_posts()
     # print(gi.get_post("5ef7d221495a755dbbcbe076"))
 
@@ -68,3 +81,5 @@ if __name__ == "__main__":
         slug = user_slug + "_" + str(year + 1) + "_" + str(year + 5)
         title = "The Years %d-%d, According to Facebook" % (year + 1, year + 5)
         gi.create_post(slug, title, posts)
+
+    fragment_cache.save()
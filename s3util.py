@@ -4,6 +4,7 @@ import logging
 import requests
 import hashlib
 import os
+import threading
 from PIL import Image
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -12,9 +13,20 @@ log = logging.getLogger(__name__)
 
 class S3:
 
+    # boto3 clients are thread safe, so one client (and its connection pool) is shared by every upload
+    _client = None
+    _client_lock = threading.Lock()
+
+    @staticmethod
+    def client():
+        with S3._client_lock:
+            if S3._client is None:
+                S3._client = boto3.client('s3')
+            return S3._client
+
     @staticmethod
     def get_keys(s3_bucket, key_prefix):
-        s3 = boto3.client('s3')
+        s3 = S3.client()
         kwargs = {'Bucket': s3_bucket, 'Prefix': key_prefix}
         while True:
             resp = s3.list_objects_v2(**kwargs)
@@ -30,13 +42,12 @@ class S3:
 
     @staticmethod
     def _upload_image_to_s3(source_image_url, s3_bucket, s3_image_key):
-        session = boto3.Session()
-        s3 = session.resource('s3')
+        s3 = S3.client()
 
         # does it exist already? if so, skip the potentially much more expensive upload
         exists = True
         try:
-            s3.Object(s3_bucket, s3_image_key).load()
+            s3.head_object(Bucket=s3_bucket, Key=s3_image_key)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 exists = False
@@ -52,15 +63,11 @@ class S3:
             raise Exception("Failed to open source image url:" + source_image_url)
 
         # upload stream to s3 as public file
-        bucket = s3.Bucket(s3_bucket)
-        bucket.upload_fileobj(response.raw, s3_image_key, ExtraArgs={'ACL': 'public-read'})
+        s3.upload_fileobj(response.raw, s3_bucket, s3_image_key, ExtraArgs={'ACL': 'public-read'})
 
     @staticmethod
     def _upload_file_to_s3(file, s3_bucket, s3_image_key):
-        session = boto3.Session()
-        s3 = session.resource('s3')
-        bucket = s3.Bucket(s3_bucket)
-        bucket.upload_file(file, s3_image_key, ExtraArgs={'ACL': 'public-read'})
+        S3.client().upload_file(file, s3_bucket, s3_image_key, ExtraArgs={'ACL': 'public-read'})
 
     @staticmethod
     def _get_s3_image_key(s3_image_folder, post_id, image):
@@ -79,7 +86,7 @@ class S3:
 
     @staticmethod
     def upload_images_to_s3(s3_bucket, s3_image_folder, posts, ignore_error=True):
-        existing_keys = [k for k in S3.get_keys(s3_bucket, s3_image_folder)]
+        existing_keys = set(S3.get_keys(s3_bucket, s3_image_folder))
 
         total = 0
         for (post_id, created_time, message, images, *_) in posts:
@@ -103,8 +110,9 @@ class S3:
 
 
     @staticmethod
-    def upload_local_images_to_s3(s3_bucket, s3_image_folder, posts, ignore_error=True, check_size=True):
-        existing_keys = [k for k in S3.get_keys(s3_bucket, s3_image_folder)]
+    def upload_local_images_to_s3(s3_bucket, s3_image_folder, posts, ignore_error=True, check_size=True, existing_keys=None):
+        if existing_keys is None:
+            existing_keys = set(S3.get_keys(s3_bucket, s3_image_folder))
 
         total = 0
         for (post_id, created_time, message, images, *_) in posts:
@@ -124,7 +132,10 @@ class S3:
                             # probably not an image? skip
                             continue
 
-                    key = S3._get_s3_image_key(s3_image_folder, post_id, image_file)
+                    # images mirrored from the Graph API are keyed on their mirror key, which unlike their signed
+                    # CDN url or the local path stays the same from run to run, and so do their urls in Ghost
+                    key_source = image.get('mirror_key', image_file)
+                    key = S3._get_s3_image_key(s3_image_folder, post_id, key_source)
                     if key in existing_keys:
                         logging.info("Skipping existing s3 image: " + key)
                     else:
@@ -136,7 +147,7 @@ class S3:
                                 logging.error("Failed to upload image " + image_file)
                             else:
                                 raise e
-                    image['src'] = S3.get_s3_image_url(s3_bucket, s3_image_folder, post_id, image_file)
+                    image['src'] = S3.get_s3_image_url(s3_bucket, s3_image_folder, post_id, key_source)
 
                     total = total + 1
 